@@ -3,13 +3,13 @@
 # Original source: https://github.com/benhoyt/pybktree.
 
 from collections import deque
-import json
 import sys
 from operator import itemgetter
+from helper import dump_pickle, load_pickle
 
 
-sys.setrecursionlimit(100000)
 _getitem0 = itemgetter(0)
+_intern = sys.intern
 
 
 class BKTree:
@@ -20,8 +20,13 @@ class BKTree:
     ----------
     distance_func : function
         Function to compute the distance between items.
+    batch_distance_func : function or None
+        Function to compute the distances between an item and a list of items in one call,
+        as batch_distance_func(item, items). When set, searches score the tree level by level.
     tree : tuple
-        Root node of the BK-tree.
+        Root node of the BK-tree, stored as (item, children).
+    word_set : set
+        Items stored in the tree, for constant time exact lookups.
 
     Methods
     -------
@@ -33,15 +38,19 @@ class BKTree:
         Converts the BK-tree to a dictionary format for saving.
     from_dict(data)
         Loads a tree structure from a dictionary format.
+    to_list()
+        Converts the BK-tree to a flat list of nodes for saving.
+    from_list(data)
+        Loads a tree structure from a flat list of nodes.
     save_to_file(filename)
-        Saves the tree to a file in JSON format.
+        Saves the tree to a file in pickle format.
     load_from_file(filename)
-        Loads the tree from a file in JSON format.
+        Loads the tree from a file in pickle format.
     fit_to_text(text_path, stop_words)
         Builds the BK-tree and computes TF-IDF based on text files.
     """
     
-    def __init__(self, distance_func):
+    def __init__(self, distance_func, batch_distance_func=None):
         """
         Initializes the BKTree with a specified distance function.
 
@@ -49,9 +58,14 @@ class BKTree:
         ----------
         distance_func : function, optional
             Function to calculate the distance between strings.
+        batch_distance_func : function, optional
+            Function to calculate the distances between a string and a list of strings
+            (default None to score one node at a time).
         """
         self.distance_func = distance_func
+        self.batch_distance_func = batch_distance_func
         self.tree = None
+        self.word_set = set()
         
     def add(self, item):
         """
@@ -60,11 +74,13 @@ class BKTree:
         Parameters
         ----------
         item : str
-            The item to be added to the tree.
+            The item to be added to the tree. Stored interned.
         """
+        item = _intern(item)
         node = self.tree
         if node is None:
             self.tree = (item, {})
+            self.word_set.add(item)
             return
 
         _distance_func = self.distance_func
@@ -77,10 +93,12 @@ class BKTree:
             if distance == 0:
                 break
 
-            node = children.get(distance)
-            if node is None:
+            child = children.get(distance)
+            if child is None:
                 children[distance] = (item, {})
+                self.word_set.add(item)
                 break
+            node = child
     
     def find(self, item, tolerance, k=-1):
         """
@@ -93,7 +111,8 @@ class BKTree:
         tolerance : int
             The maximum allowable distance for search matches.
         k : int, optional
-            The number of results to return (default is -1 for unlimited).
+            The number of results to return (default is -1 for unlimited). When limited,
+            an item that is stored in the tree is returned on its own without a search.
 
         Returns
         -------
@@ -104,8 +123,11 @@ class BKTree:
             return []
 
         found = [(0, item)]
-        if len(item) <= 3:
+        if len(item) <= 3 or (k != -1 and item in self.word_set):
             return found
+
+        if self.batch_distance_func is not None:
+            return self._find_by_level(item, tolerance, k, found)
         
         candidates = deque([self.tree])
         _candidates_popleft = candidates.popleft
@@ -120,14 +142,64 @@ class BKTree:
             if distance <= tolerance:
                 _found_append((distance, candidate))
                 count += 1
-            
-            if count == k:
-                break
+                if count == k:
+                    break
 
             if children:
                 lower = distance - tolerance
                 upper = distance + tolerance
-                _candidates_extend(c for d, c in children.items() if lower <= d <= upper)
+                _candidates_extend([c for d, c in children.items() if lower <= d <= upper])
+
+        found.sort(key=_getitem0)
+        return found
+
+    def _find_by_level(self, item, tolerance, k, found):
+        """
+        Breadth-first search that scores each level of candidates with a single batch call.
+
+        Visits nodes in the same order as `find`, but cannot cut individual distance
+        computations short.
+
+        Parameters
+        ----------
+        item : str
+            The target item to search for.
+        tolerance : int
+            The maximum allowable distance for search matches.
+        k : int
+            The number of results to return (-1 for unlimited).
+        found : list
+            List of tuples with distance and item to append matches to.
+
+        Returns
+        -------
+        list
+            List of tuples with distance and item.
+        """
+        _found_append = found.append
+        _batch_distance_func = self.batch_distance_func
+
+        count = 0
+        frontier = [self.tree]
+        while frontier:
+            distances = _batch_distance_func(item, [node[0] for node in frontier])
+            next_frontier = []
+            _next_frontier_extend = next_frontier.extend
+
+            for (candidate, children), distance in zip(frontier, distances):
+                if distance <= tolerance:
+                    _found_append((distance, candidate))
+                    count += 1
+                    if count == k:
+                        found.sort(key=_getitem0)
+                        return found
+
+                if children:
+                    lower = distance - tolerance
+                    upper = distance + tolerance
+                    _next_frontier_extend([c for d, c in children.items() if lower <= d <= upper])
+
+            frontier = next_frontier
 
         found.sort(key=_getitem0)
         return found
@@ -151,16 +223,25 @@ class BKTree:
         
         if node is None:
             return None
-        
-        item, children = node
-        return {
-            'item': item,
-            'children': {distance: self.to_dict(child) for distance, child in children.items()}
-        }
+
+        root = {}
+        stack = [(root, node)]
+        _stack_pop = stack.pop
+        _stack_append = stack.append
+
+        while stack:
+            data, (item, children) = _stack_pop()
+            data['item'] = item
+            data['children'] = children_data = {}
+            for distance, child in children.items():
+                children_data[distance] = child_data = {}
+                _stack_append((child_data, child))
+
+        return root
     
     def from_dict(self, data):
         """
-        Loads a BKTree structure from a dictionary.
+        Loads a BKTree structure from a dictionary and rebuilds `word_set`.
 
         Parameters
         ----------
@@ -174,31 +255,98 @@ class BKTree:
         """
         if data is None:
             return None
-        
-        item = data['item']
-        children = {int(distance): self.from_dict(child) for distance, child in data['children'].items()}
-        return (item, children)
+
+        word_set = self.word_set = set()
+        root_children = {}
+        stack = [(root_children, data)]
+        _stack_pop = stack.pop
+        _stack_append = stack.append
+
+        while stack:
+            children, node_data = _stack_pop()
+            for distance, child_data in node_data['children'].items():
+                item = _intern(child_data['item'])
+                word_set.add(item)
+                child_children = {}
+                children[int(distance)] = (item, child_children)
+                _stack_append((child_children, child_data))
+
+        item = _intern(data['item'])
+        word_set.add(item)
+        return (item, root_children)
     
+    def to_list(self):
+        """
+        Converts the BKTree structure to a flat list of nodes.
+
+        Nodes are numbered in breadth-first order, with the root at index 0.
+
+        Returns
+        -------
+        list
+            List of (item, [(distance, child_index), ...]) tuples, empty if the tree is empty.
+        """
+        if self.tree is None:
+            return []
+
+        nodes = [self.tree]
+        _nodes_append = nodes.append
+        data = []
+        _data_append = data.append
+
+        # nodes grows while it is iterated, so this walks the whole tree
+        for item, children in nodes:
+            edges = []
+            for distance, child in children.items():
+                edges.append((distance, len(nodes)))
+                _nodes_append(child)
+            _data_append((item, edges))
+
+        return data
+
+    def from_list(self, data):
+        """
+        Loads a BKTree structure from a flat list of nodes and rebuilds `word_set`.
+
+        Parameters
+        ----------
+        data : list
+            Flat list format of BKTree structure, as returned by `to_list`.
+
+        Returns
+        -------
+        tuple or None
+            The root node of the BKTree or None if empty.
+        """
+        if not data:
+            return None
+
+        nodes = [(_intern(item), {}) for item, _ in data]
+        self.word_set = {node[0] for node in nodes}
+        for (_, children), (_, edges) in zip(nodes, data):
+            for distance, child_index in edges:
+                children[distance] = nodes[child_index]
+
+        return nodes[0]
+
     def save_to_file(self, filename):
         """
-        Saves the BKTree to a file in JSON format.
+        Saves the BKTree to a file in pickle format.
 
         Parameters
         ----------
         filename : str
-            Path to save the JSON file.
+            Path to save the pickle file.
         """
-        with open(filename, 'w') as f:
-            json.dump(self.to_dict(), f)
+        dump_pickle(self.to_list(), filename)
     
     def load_from_file(self, filename):
         """
-        Loads the BKTree from a JSON file.
+        Loads the BKTree from a pickle file.
 
         Parameters
         ----------
         filename : str
-            Path of the JSON file to load.
+            Path of the pickle file to load.
         """
-        with open(filename, 'r') as f:
-            self.tree = self.from_dict(json.load(f))
+        self.tree = self.from_list(load_pickle(filename))
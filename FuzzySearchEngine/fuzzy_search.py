@@ -1,17 +1,163 @@
 import io
-from collections import defaultdict
+import multiprocessing
+import os
+import sys
+import weakref
 from bktree import BKTree
-from helper import fuzzy_ratio_distance
+from helper import fuzzy_ratio_distance, fuzzy_ratio_distances, load_pickle
 from symspellpy.symspellpy import SymSpell, Verbosity
 import pickle
 import numpy as np
-import concurrent.futures
-import heapq
-from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain, repeat
 
 
-_getitem1_0 = itemgetter(1, 0)
-_npUnique = np.unique
+# Queries with fewer words than this are searched in the calling process, where
+# the per-word cost is lower than a worker round trip
+_MIN_PARALLEL_WORDS = 2
+
+# Relative rounding error allowed per float32 score addition, half for the sum and half for the addend
+_FLOAT32_EPS = float(np.finfo(np.float32).eps)
+
+# Forked workers share the loaded models copy-on-write, other start methods pickle them
+_MP_CONTEXT = (
+    multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+)
+
+# BK-tree and SymSpell models of the current search worker process
+_worker_bktree = None
+_worker_sym_spell = None
+
+
+def _init_worker(bktree, sym_spell):
+    """
+    Stores the search models in a search worker process.
+
+    Parameters
+    ----------
+    bktree : BKTree
+        BK-tree to search in this worker.
+    sym_spell : SymSpell
+        SymSpell instance to search in this worker.
+    """
+    global _worker_bktree, _worker_sym_spell
+    _worker_bktree = bktree
+    _worker_sym_spell = sym_spell
+
+
+def _find_in_worker(word, tolerance, n):
+    """
+    Runs a BK-tree search in a search worker process.
+
+    Parameters
+    ----------
+    word : str
+        Query term.
+    tolerance : int
+        Max allowable distance for fuzzy matching.
+    n : int
+        Limit on the number of BK-tree matches (-1 for unlimited).
+
+    Returns
+    -------
+    list
+        List of tuples with distance and matched term.
+    """
+    return _worker_bktree.find(word, tolerance, n)
+
+
+def _lookup(sym_spell, word, verbosity, max_edit_distance):
+    """
+    Runs a SymSpell lookup.
+
+    Parameters
+    ----------
+    sym_spell : SymSpell
+        SymSpell instance to search.
+    word : str
+        Query term.
+    verbosity : Verbosity
+        SymSpell verbosity mode for match ranking.
+    max_edit_distance : int
+        Max edit distance for matches.
+
+    Returns
+    -------
+    list
+        List of tuples with distance and matched term.
+    """
+    return [(s.distance, s.term) for s in sym_spell.lookup(word, verbosity, max_edit_distance=max_edit_distance)]
+
+
+def _lookup_in_worker(word, verbosity, max_edit_distance):
+    """
+    Runs a SymSpell lookup in a search worker process.
+
+    Parameters
+    ----------
+    word : str
+        Query term.
+    verbosity : Verbosity
+        SymSpell verbosity mode for match ranking.
+    max_edit_distance : int
+        Max edit distance for matches.
+
+    Returns
+    -------
+    list
+        List of tuples with distance and matched term.
+    """
+    return _lookup(_worker_sym_spell, word, verbosity, max_edit_distance)
+
+
+def _accumulate_ratio(document_scores, doc_ids, match_score, L, prev_docs, tfidf):
+    """
+    Applies `FuzzySearch.score_match_query_ratio` to every document of a match.
+    """
+    # doc_ids holds each document once, so fancy-indexed updates do not collide
+    document_scores[doc_ids] += match_score / L
+
+
+def _accumulate_ratio_with_penalty(document_scores, doc_ids, match_score, L, prev_docs, tfidf):
+    """
+    Applies `FuzzySearch.score_match_query_ratio_with_penalty` to every document of a match.
+    """
+    counts = prev_docs[doc_ids] + 1
+    prev_docs[doc_ids] = counts
+    document_scores[doc_ids] += (match_score / L) / counts
+
+
+def _top_k_settled(document_scores, kth, remaining, L, n):
+    """
+    Checks whether the top-k documents can still change under the ratio scoring functions.
+
+    Each remaining word adds at most 1 / L to a document's score, through at most n + 1
+    matches. Scores are float32, so every one of those additions may also round up by a
+    relative eps; the bound is widened by that much, so a document that could still tie
+    with the k-th best keeps the search going.
+
+    Parameters
+    ----------
+    document_scores : ndarray
+        Array of float32 document scores, indexed by document ID.
+    kth : tuple
+        Positions (num_docs - k - 1, num_docs - k) of the best document outside the top-k
+        and of the k-th best document in sorted order.
+    remaining : int
+        Number of query words not yet scored.
+    L : int
+        Number of query words.
+    n : int
+        Limit on the number of BK-tree matches per word.
+
+    Returns
+    -------
+    bool
+        True if no document outside the top-k can reach the k-th best score.
+    """
+    next_score, kth_score = np.partition(document_scores, kth)[list(kth)].tolist()
+    return kth_score - next_score > remaining / L + remaining * (n + 1) * _FLOAT32_EPS
 
 
 class FuzzySearch:
@@ -22,14 +168,18 @@ class FuzzySearch:
 
     Attributes
     ----------
-    stop_words : dict
+    stop_words : frozenset
         Set of stop words to exclude from search processing.
     tfidf : ndarray
         TF-IDF matrix for document feature weighting.
     feature_map : dict
         Mapping from terms to indices in the TF-IDF matrix.
+    documents : list
+        Names of the indexed documents, indexed by document ID.
+    num_docs : int
+        Number of indexed documents.
     word_documents : dict
-        Mapping from words to lists of document IDs containing those words.
+        Mapping from words to arrays of document IDs containing those words.
     bktree : BKTree
         BK-tree for fast fuzzy matching of terms.
     sym_spell : SymSpell
@@ -45,12 +195,16 @@ class FuzzySearch:
         Adjusts document ranking based on TF-IDF scores.
     score_match_query_tfidf_with_penalty
         Adjusts document ranking with TF-IDF and repetition penalty.
+    accumulator_for
+        Returns a function that applies a scoring function to all documents of a match.
     search_bktree
         Searches documents using the BK-tree.
     search_symspell
         Searches documents using SymSpell.
     find_relevant_documents
         Returns relevant documents for a given query.
+    close
+        Shuts down the search worker processes.
     """
 
     @classmethod
@@ -60,15 +214,15 @@ class FuzzySearch:
 
         Parameters
         ----------
-        document_scores : defaultdict
-            Dictionary of document scores for ranking.
-        doc_id : str
+        document_scores : ndarray
+            Array of document scores for ranking, indexed by document ID.
+        doc_id : int
             Document ID to score.
         match_score : float
             Fuzzy match score for the document.
         L : float
             Length factor for query normalization.
-        prev_docs : defaultdict
+        prev_docs : ndarray
             Track previous document matches to apply penalty.
         tfidf : float
             TF-IDF score for the matched word in the document.
@@ -83,15 +237,15 @@ class FuzzySearch:
 
         Parameters
         ----------
-        document_scores : defaultdict
-            Dictionary of document scores for ranking.
-        doc_id : str
+        document_scores : ndarray
+            Array of document scores for ranking, indexed by document ID.
+        doc_id : int
             Document ID to score.
         match_score : float
             Fuzzy match score for the document.
         L : float
             Length factor for query normalization.
-        prev_docs : defaultdict
+        prev_docs : ndarray
             Track previous document matches (not used here).
         tfidf : float
             TF-IDF score for the matched word in the document.
@@ -105,15 +259,15 @@ class FuzzySearch:
 
         Parameters
         ----------
-        document_scores : defaultdict
-            Dictionary of document scores for ranking.
-        doc_id : str
+        document_scores : ndarray
+            Array of document scores for ranking, indexed by document ID.
+        doc_id : int
             Document ID to score.
         match_score : float
             Fuzzy match score for the document.
         L : float
             Length factor for query normalization.
-        prev_docs : defaultdict
+        prev_docs : ndarray
             Track previous document matches (not used here).
         tfidf : float
             TF-IDF score for the matched word in the document.
@@ -127,15 +281,15 @@ class FuzzySearch:
 
         Parameters
         ----------
-        document_scores : defaultdict
-            Dictionary of document scores for ranking.
-        doc_id : str
+        document_scores : ndarray
+            Array of document scores for ranking, indexed by document ID.
+        doc_id : int
             Document ID to score.
         match_score : float
             Fuzzy match score for the document.
         L : float
             Length factor for query normalization.
-        prev_docs : defaultdict
+        prev_docs : ndarray
             Track previous document matches to apply penalty.
         tfidf : float
             TF-IDF score for the matched word in the document.
@@ -143,6 +297,35 @@ class FuzzySearch:
         prev_docs[doc_id] += 1
         document_scores[doc_id] += match_score * tfidf / (L * prev_docs[doc_id])
 
+    @classmethod
+    def accumulator_for(cls, score_func):
+        """
+        Returns a function that applies a scoring function to all documents of a match.
+
+        The ratio scoring functions get vectorized updates over the documents; any other
+        scoring function is called once per document.
+
+        Parameters
+        ----------
+        score_func : function
+            Scoring function to rank documents.
+
+        Returns
+        -------
+        function
+            Function with the arguments of score_func, taking an array of document IDs instead of doc_id.
+        """
+        if score_func == cls.score_match_query_ratio_with_penalty:
+            return _accumulate_ratio_with_penalty
+        if score_func == cls.score_match_query_ratio:
+            return _accumulate_ratio
+
+        def accumulate(document_scores, doc_ids, match_score, L, prev_docs, tfidf):
+            for doc_id in doc_ids:
+                score_func(document_scores, doc_id, match_score, L, prev_docs, tfidf)
+
+        return accumulate
+
     def __init__(self, index_dir='./indexes', stop_words_path="./indexes/stop-words.txt"):
         """
         Initialize FuzzySearch with data from index files.
@@ -156,25 +339,131 @@ class FuzzySearch:
         """
         # Load stop words
         self.stop_words = (
-            {w: 0 for w in io.open(stop_words_path, mode='r', encoding="utf-8").read().split(',')}
+            frozenset(io.open(stop_words_path, mode='r', encoding="utf-8").read().split(','))
             if stop_words_path
-            else {}
+            else frozenset()
         )
 
         # Load serialized index data
-        # with open(f'{index_dir}/tfidf.pickle', 'rb') as handle:
-        #     self.tfidf = pickle.load(handle)
+        # self.tfidf = load_pickle(f'{index_dir}/tfidf.pickle')
         # with open(f'{index_dir}/feature_map.pickle', 'rb') as handle:
         #     self.feature_map = pickle.load(handle)
-        with open(f'{index_dir}/word_documents.pickle', 'rb') as handle:
-            self.word_documents = pickle.load(handle)
+        with open(f'{index_dir}/documents.pickle', 'rb') as handle:
+            self.documents = pickle.load(handle)
+        self.num_docs = len(self.documents)
+        # Posting lists are views into one concatenated array. Interned keys share their
+        # strings with the BK-tree items
+        words, offsets, postings = load_pickle(f'{index_dir}/word_documents.pickle')
+        postings = postings.astype(np.int32)
+        offsets = offsets.tolist()
+        self.word_documents = {
+            sys.intern(word): postings[start:end] for word, start, end in zip(words, offsets, offsets[1:])
+        }
 
         # Load BK-tree and SymSpell models
-        self.bktree = BKTree(fuzzy_ratio_distance)
-        self.bktree.load_from_file(f'{index_dir}/bktree.json')
+        self.bktree = BKTree(fuzzy_ratio_distance, fuzzy_ratio_distances)
+        self.bktree.load_from_file(f'{index_dir}/bktree.pickle')
         self.sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=5)
         self.sym_spell.load_dictionary(f'{index_dir}/word_counts.txt', term_index=0, count_index=1)
 
+        # Worker processes for larger queries, created on first use
+        self._max_workers = os.cpu_count() or 1
+        self._executor = None
+        self._shutdown_executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Shuts down the search worker processes, if any were started.
+
+        The engine stays usable and starts new workers when a larger query needs them.
+        """
+        if self._executor is not None:
+            self._shutdown_executor()
+            self._executor = None
+            self._shutdown_executor = None
+
+    def _map_words(self, worker_func, local_func, words, *args):
+        """
+        Applies a search function to each word, in worker processes when worthwhile.
+
+        BK-tree search and SymSpell lookups are pure Python and hold the GIL, so larger
+        queries are spread over worker processes. Workers are forked where the platform
+        supports it and inherit the models without copying them. Elsewhere, as on Windows,
+        workers are spawned and each one unpickles its own copy of the models on start.
+        Smaller queries, or hosts with a single CPU, are searched lazily in this process.
+
+        Parameters
+        ----------
+        worker_func : function
+            Search function for worker processes, called as worker_func(word, *args).
+        local_func : function
+            Equivalent search function for this process, called as local_func(word, *args).
+        words : list
+            List of query terms.
+        *args
+            Further arguments for the search function.
+
+        Returns
+        -------
+        iterator
+            Search results for each word, in order.
+        """
+        if len(words) < _MIN_PARALLEL_WORDS or self._max_workers == 1:
+            return (local_func(word, *args) for word in words)
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._max_workers,
+                mp_context=_MP_CONTEXT,
+                initializer=_init_worker,
+                initargs=(self.bktree, self.sym_spell),
+            )
+            # Stops the workers when the engine is dropped without close()
+            self._shutdown_executor = weakref.finalize(self, self._executor.shutdown)
+        return self._executor.map(worker_func, words, *(repeat(arg) for arg in args))
+
+    def _top_documents(self, document_scores, k):
+        """
+        Selects the highest scoring documents.
+
+        Parameters
+        ----------
+        document_scores : ndarray
+            Array of document scores, indexed by document ID.
+        k : int
+            Number of top documents to return.
+
+        Returns
+        -------
+        list
+            Top-k document names with corresponding scores, for documents with a non-zero score.
+            Documents with equal scores are ranked by document ID, lowest first.
+        """
+        if k <= 0:
+            return []
+
+        doc_ids = np.flatnonzero(document_scores)
+        scores = document_scores[doc_ids]
+        if len(doc_ids) > k:
+            # Keep every document above the k-th best score, and fill up with the lowest IDs
+            # among the documents tied with it
+            kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+            above = scores > kth_score
+            tied = np.flatnonzero(scores == kth_score)[:k - np.count_nonzero(above)]
+            top = np.concatenate((np.flatnonzero(above), tied))
+            doc_ids = doc_ids[top]
+            scores = scores[top]
+
+        order = np.lexsort((doc_ids, -scores))
+        _documents = self.documents
+        return [(_documents[doc_id], score) for doc_id, score in zip(doc_ids[order].tolist(), scores[order].tolist())]
+
     def search_bktree(self, words, k, score_func, n):
         """
         Searches for documents using the BK-tree for fuzzy matching.
@@ -196,26 +485,45 @@ class FuzzySearch:
             Top-k documents ranked by similarity with corresponding scores.
         """
         L = len(words)
-        document_scores = defaultdict(float)
+        num_docs = self.num_docs
+        document_scores = np.zeros(num_docs, dtype=np.float32)
+        accumulate = self.accumulator_for(score_func)
+        _get_documents = self.word_documents.get
         tolerance = 20  # Max allowable distance for fuzzy matching
 
-        # Perform BK-tree search in parallel for each word
-        _find = self.bktree.find
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_query = {executor.submit(_find, word, tolerance, n): word for word in words}
-            results = [future.result() for future in concurrent.futures.as_completed(future_to_query)]
+        # Perform BK-tree search in parallel for each word. Words of up to 3 characters
+        # only match themselves, so they are resolved here instead of in a worker.
+        results = chain(
+            ([(0, w)] for w in words if len(w) <= 3),
+            self._map_words(_find_in_worker, self.bktree.find, [w for w in words if len(w) > 3], tolerance, n),
+        )
+
+        # With the ratio scoring functions a word adds at most 1 / L to a document's score,
+        # so in approximate mode the top-k documents are settled once no document outside
+        # them can catch up. Exact mode (n == -1) always scores every word.
+        early_exit = (
+            n != -1 and 0 < k < num_docs
+            and accumulate in (_accumulate_ratio, _accumulate_ratio_with_penalty)
+        )
+        kth = (num_docs - k - 1, num_docs - k)
+        remaining = L
 
         # Rank documents based on matches
         for matches in results:
-            prev_docs = defaultdict(int)
+            prev_docs = np.zeros(num_docs, dtype=np.int32)
+            norm = L * len(matches)
             for distance, match in matches:
-                match_score = 1 / (distance + 1)
-                if match not in self.word_documents: #self.feature_map:
+                doc_ids = _get_documents(match) #self.feature_map
+                if doc_ids is None:
                     continue
-                for doc_id in self.word_documents[match]:
-                    score_func(document_scores, doc_id, match_score, L * len(matches), prev_docs, None) #, self.tfidf[doc_id][self.feature_map[match]])
+                match_score = 1 / (distance + 1)
+                accumulate(document_scores, doc_ids, match_score, norm, prev_docs, None) #, self.tfidf[doc_id][self.feature_map[match]])
+
+            remaining -= 1
+            if early_exit and remaining and _top_k_settled(document_scores, kth, remaining, L, n):
+                break
 
-        return heapq.nlargest(k, document_scores.items(), key=_getitem1_0)
+        return self._top_documents(document_scores, k)
 
     def search_symspell(self, words, k, score_func, verbosity=Verbosity.CLOSEST):
         """
@@ -238,24 +546,24 @@ class FuzzySearch:
             Top-k documents ranked by similarity with corresponding scores.
         """
         L = len(words)
-        document_scores = defaultdict(float)
+        num_docs = self.num_docs
+        document_scores = np.zeros(num_docs, dtype=np.float32)
+        accumulate = self.accumulator_for(score_func)
+
+        _word_documents = self.word_documents
 
-        # Perform SymSpell lookup for each word
-        _lookup = self.sym_spell.lookup
-        results = [
-            [(s.distance, s.term) for s in _lookup(w, verbosity, max_edit_distance=2)]
-            for w in words
-        ]
+        # Perform SymSpell lookup in parallel for each word
+        results = self._map_words(_lookup_in_worker, partial(_lookup, self.sym_spell), words, verbosity, 2)
 
         # Rank documents based on matches
         for matches in results:
-            prev_docs = defaultdict(int)
+            prev_docs = np.zeros(num_docs, dtype=np.int32)
+            norm = L * len(matches)
             for distance, match in matches:
                 match_score = 1 / (distance + 1)
-                for doc_id in self.word_documents[match]:
-                    score_func(document_scores, doc_id, match_score, L * len(matches), prev_docs, None)
+                accumulate(document_scores, _word_documents[match], match_score, norm, prev_docs, None)
 
-        return heapq.nlargest(k, document_scores.items(), key=_getitem1_0)
+        return self._top_documents(document_scores, k)
 
     def find_relevant_documents(self, query, k=20, score_func=None, n=-1):
         """
@@ -282,8 +590,10 @@ class FuzzySearch:
         if score_func == None:
             score_func = self.score_match_query_ratio_with_penalty
 
-        # Preprocess query: remove stop words and get unique words
-        words = _npUnique([word for word in query.split() if word not in self.stop_words])
+        # Preprocess query: remove stop words and get unique words, in query order so float32
+        # scores are accumulated in the same order on every run
+        _stop_words = self.stop_words
+        words = list(dict.fromkeys(word for word in query.split() if word not in _stop_words))
 
         # For large queries, use SymSpell; otherwise, use BK-tree
         if len(words) > 86:
@@ -1,26 +1,31 @@
 import argparse
+import re
 from fuzzy_search import FuzzySearch
 
 
+# Search command in the format of find-<k>:<query>, allowing whitespace around the prefix and k
+_FIND_COMMAND = re.compile(r'\s*find-\s*(\d+)\s*:(.*)', re.DOTALL)
+
+
 def run_search_terminal(index_dir, stop_words_path):
-    search_engine = FuzzySearch(index_dir, stop_words_path)
-    _find = search_engine.find_relevant_documents
-
-    while True:
-        cmd = input('>search query:')
-        if (cmd == 'exit()'):
-            break
-
-        cmds = cmd.split(':')
-        
-        if len(cmds[0].split('-')) != 2 :
-            print('Input command must be in the format of find-<k>:<query>')
-            continue
-
-        k = int(cmds[0].split('-')[1])
-        results = _find(cmds[1], k)
-        for r in results:
-            print(f'Document ID: {r[0]}, Score: {r[1]}')
+    with FuzzySearch(index_dir, stop_words_path) as search_engine:
+        _find = search_engine.find_relevant_documents
+        _match_find = _FIND_COMMAND.fullmatch
+
+        while True:
+            cmd = input('>search query:')
+            if (cmd == 'exit()'):
+                break
+
+            match = _match_find(cmd)
+            if match is None:
+                print('Input command must be in the format of find-<k>:<query>')
+                continue
+
+            k, query = match.groups()
+            results = _find(query, int(k))
+            for r in results:
+                print(f'Document ID: {r[0]}, Score: {r[1]}')
 
 
 if __name__ == '__main__':
@@ -1,9 +1,28 @@
-from rapidfuzz import fuzz
+import os
+import pickle
+import struct
+from rapidfuzz import fuzz, process
+from rapidfuzz.distance import Indel
+import numpy as np
 
 
+# fuzz.ratio scores the Indel distance with rapidfuzz's bit-parallel kernels, which
+# stay faster than StringZilla's alignment scoring even for long strings. Levenshtein
+# based scorers are not a drop-in replacement, as the BK-tree metric would change.
 _fuzzratio = fuzz.ratio
+_cdist = process.cdist
+# Single comparisons compute fuzz.ratio's (1 - distance / (len(s1) + len(s2))) * 100
+# from Indel.distance directly. Per call this is about twice as fast on rapidfuzz 3.8,
+# and on par with fuzz.ratio on rapidfuzz 3.14, where its call path got cheaper
+_indel_distance = Indel.distance
 _int = int
 
+# Out-of-band pickle files start with a tag whose last byte is the format version,
+# and store counts and lengths as little-endian 64-bit integers
+_PICKLE_MAGIC = b'FRSEPKL\x01'
+_length = struct.Struct('<Q')
+_FILE_BUFFER_SIZE = 1 << 20
+
 
 def fuzzy_ratio_distance(s1, s2):
     """
@@ -21,4 +40,97 @@ def fuzzy_ratio_distance(s1, s2):
     int
         The distance score between 0 and 100.
     """
-    return 100 - _int(_fuzzratio(s1, s2))
\ No newline at end of file
+    lensum = len(s1) + len(s2)
+    if not lensum:
+        return 0
+    return 100 - _int((1.0 - _indel_distance(s1, s2) / lensum) * 100)
+
+
+def fuzzy_ratio_distances(s, choices):
+    """
+    Calculate the fuzzy ratio distance between a string and each of the choices in one call.
+
+    Parameters
+    ----------
+    s : str
+        String to compare.
+    choices : list of str
+        Strings to compare against.
+
+    Returns
+    -------
+    list of int
+        The distance scores between 0 and 100, in the order of choices.
+    """
+    scores = _cdist([s], choices, scorer=_fuzzratio, dtype=np.float64)[0]
+    return (100 - scores.astype(np.int64)).tolist()
+
+
+def dump_pickle(obj, filename):
+    """
+    Saves an object to a file in pickle protocol 5 format, with its buffers out-of-band.
+
+    Buffers such as NumPy array data are written to the file as they are, without being
+    copied into the pickle stream. The file holds a format tag, the number of buffers,
+    each buffer prefixed with its length, and then the pickle stream.
+
+    Parameters
+    ----------
+    obj : object
+        Object to save.
+    filename : str
+        Path to save the pickle file.
+    """
+    buffers = []
+    stream = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    with open(filename, 'wb', buffering=_FILE_BUFFER_SIZE) as f:
+        f.write(_PICKLE_MAGIC)
+        f.write(_length.pack(len(buffers)))
+        for buffer in buffers:
+            raw = buffer.raw()
+            f.write(_length.pack(raw.nbytes))
+            f.write(raw)
+        f.write(stream)
+
+
+def load_pickle(filename):
+    """
+    Loads an object from a file saved by `dump_pickle`.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the pickle file to load.
+
+    Returns
+    -------
+    object
+        The loaded object. Its buffers are read straight into writable memory.
+
+    Raises
+    ------
+    ValueError
+        If the file was written in another format, or is truncated or corrupted.
+    """
+    with open(filename, 'rb', buffering=_FILE_BUFFER_SIZE) as f:
+        if f.read(len(_PICKLE_MAGIC)) != _PICKLE_MAGIC:
+            raise ValueError(f'{filename} is not in the current index format, rebuild the index')
+
+        _read = f.read
+        _readinto = f.readinto
+        _tell = f.tell
+        file_size = os.fstat(f.fileno()).st_size
+        try:
+            buffers = []
+            for _ in range(_length.unpack(_read(_length.size))[0]):
+                size = _length.unpack(_read(_length.size))[0]
+                # Checked before allocating, so a corrupted length fails without a huge allocation
+                if size > file_size - _tell():
+                    raise EOFError
+                buffer = bytearray(size)
+                if _readinto(buffer) != size:
+                    raise EOFError
+                buffers.append(buffer)
+            return pickle.load(f, buffers=buffers)
+        except (struct.error, EOFError, pickle.UnpicklingError) as e:
+            raise ValueError(f'{filename} is truncated or corrupted, rebuild the index') from e
@@ -1,40 +1,226 @@
 import os
 import argparse
 import io
+import re
+import string
+import sys
 import pickle
-from sklearn.feature_extraction.text import TfidfVectorizer
-from collections import defaultdict
-from pathlib import Path
+import random
+from array import array
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfTransformer
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
 from bktree import BKTree
-from helper import fuzzy_ratio_distance
+from helper import fuzzy_ratio_distance, dump_pickle
 
 
-def compute_tfidf(corpus, stop_words):
+_intern = sys.intern
+
+_SLOVENIAN_ALPHABET = "abcčćdđeéfghijklmnoópqrsštuvwxyzž "
+
+# Runs of characters outside the Slovenian alphabet, deleted from the text before splitting
+_NON_ALPHABET = re.compile(f"[^{_SLOVENIAN_ALPHABET}]+")
+_strip_non_alphabet = _NON_ALPHABET.sub
+
+# ASCII files are lowercased and filtered byte by byte, before decoding
+_ASCII_LOWERCASE = bytes.maketrans(string.ascii_uppercase.encode(), string.ascii_lowercase.encode())
+_ASCII_NON_ALPHABET = bytes(b for b in range(128) if chr(b).lower() not in _SLOVENIAN_ALPHABET)
+
+# Number of files sent to an indexing worker process at a time, and how many such batches
+# per worker may be submitted ahead of the merge
+_FILES_PER_TASK = 16
+_BATCHES_AHEAD_PER_WORKER = 2
+
+# Threads reading files when indexing in a single process, and how many files they may read ahead
+_READ_THREADS = 8
+_FILES_READ_AHEAD = 32
+
+# Seed of the BK-tree insertion order, fixed so rebuilding an index gives the same tree
+_BKTREE_SEED = 0
+
+
+def compute_tfidf(document_counts):
     """
-    Compute TF-IDF matrix and feature map for a given corpus.
+    Compute TF-IDF matrix and feature map from the word counts of each document.
+
+    The counts are assembled into a sparse term count matrix directly, so the text is not
+    tokenized a second time.
 
     Parameters
     ----------
-    corpus : list of str
-        List of documents to analyze.
-    stop_words : set
-        Set of stop words to exclude from analysis.
+    document_counts : list of dict
+        Number of occurrences of each word, for each document. Stop words should already
+        be excluded.
 
     Returns
     -------
     tuple
-        tfidf_array (ndarray): Matrix representing TF-IDF scores.
-        feature_map (dict): Mapping of terms to column indices in tfidf_array.
-    """
-    tfidf_vectorizer = TfidfVectorizer(stop_words=stop_words)
-    tfidf_matrix = tfidf_vectorizer.fit_transform(corpus)
-    tfidf_array = tfidf_matrix.toarray()
-    feature_names = tfidf_vectorizer.get_feature_names_out()
-    feature_map = {feature_names[i]: i for i in range(len(feature_names))}
-    
-    return tfidf_array, feature_map
+        tfidf_matrix (csr_matrix): Sparse matrix representing TF-IDF scores.
+        feature_map (dict): Mapping of terms to column indices in tfidf_matrix.
+    """
+    feature_map = {}
+    _feature_id = feature_map.setdefault
+    indptr = array('q', (0,))
+    indices = array('i')
+    data = array('i')
+
+    for counts in document_counts:
+        # Columns are numbered in order of first appearance
+        indices.extend([_feature_id(word, len(feature_map)) for word in counts])
+        data.extend(counts.values())
+        indptr.append(len(indices))
+
+    term_counts = csr_matrix(
+        (np.frombuffer(data, dtype=np.intc), np.frombuffer(indices, dtype=np.intc), np.frombuffer(indptr, dtype=np.int64)),
+        shape=(len(document_counts), len(feature_map))
+    )
+    tfidf_matrix = TfidfTransformer().fit_transform(term_counts)
+
+    return tfidf_matrix, feature_map
+
+def _read_file(path):
+    """
+    Reads the contents of a file.
+
+    Parameters
+    ----------
+    path : str
+        File to read.
+
+    Returns
+    -------
+    bytes
+        Contents of the file.
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _count_text_words(data, stop_words):
+    """
+    Counts the words of a UTF-8 encoded text.
+
+    Parameters
+    ----------
+    data : bytes
+        Text to process.
+    stop_words : set
+        Set of stop words to ignore during processing.
+
+    Returns
+    -------
+    Counter
+        Number of occurrences of each word in the text.
+    """
+    if data.isascii():
+        text = data.translate(_ASCII_LOWERCASE, _ASCII_NON_ALPHABET).decode('ascii')
+    else:
+        text = _strip_non_alphabet('', data.decode('utf-8', 'ignore').lower())
+    words = text.split()
+
+    return Counter(word for word in words if word not in stop_words)
+
+def _count_words(path, stop_words):
+    """
+    Reads a text file and counts its words.
+
+    Parameters
+    ----------
+    path : str
+        Text file to process.
+    stop_words : set
+        Set of stop words to ignore during processing.
+
+    Returns
+    -------
+    Counter
+        Number of occurrences of each word in the file.
+    """
+    return _count_text_words(_read_file(path), stop_words)
+
+def _count_files(paths, stop_words):
+    """
+    Reads a batch of text files and counts the words of each.
+
+    Parameters
+    ----------
+    paths : list of str
+        Text files to process.
+    stop_words : set
+        Set of stop words to ignore during processing.
+
+    Returns
+    -------
+    list of Counter
+        Number of occurrences of each word, for each file in order.
+    """
+    return [_count_words(path, stop_words) for path in paths]
+
+def _map_ahead(executor, func, items, ahead):
+    """
+    Applies a function to each item in an executor, a bounded number of items ahead of the consumer.
+
+    Unlike Executor.map, which submits every item at once, at most `ahead` results are
+    pending or waiting to be consumed at any time.
+
+    Parameters
+    ----------
+    executor : Executor
+        Executor to call the function in.
+    func : function
+        Function to apply, called as func(item).
+    items : iterable
+        Items to process.
+    ahead : int
+        Maximum number of items submitted ahead of the consumer.
+
+    Yields
+    ------
+    object
+        Result for each item, in order.
+    """
+    pending = deque()
+    _pending_append = pending.append
+    _pending_popleft = pending.popleft
+    _submit = executor.submit
+
+    for item in items:
+        _pending_append(_submit(func, item))
+        if len(pending) > ahead:
+            yield _pending_popleft().result()
+
+    while pending:
+        yield _pending_popleft().result()
 
-def index_files(text_path, stop_words):
+def _walk_txt(root):
+    """
+    Finds the text files in a directory tree, in the same order as Path.rglob('*.txt').
+
+    Parameters
+    ----------
+    root : str
+        Directory to search.
+
+    Yields
+    ------
+    os.DirEntry
+        Entry of each text file, with its path and name as strings.
+    """
+    directories = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.name.endswith('.txt') and entry.is_file():
+                yield entry
+
+    for directory in directories:
+        yield from _walk_txt(directory)
+
+def index_files(text_path, stop_words, workers=None):
     """
     Builds BKTree index, SymSpell index and computes TF-IDF based on text files.
 
@@ -44,72 +230,131 @@ def index_files(text_path, stop_words):
         Directory containing text files to process.
     stop_words : set
         Set of stop words to ignore during processing.
+    workers : int, optional
+        Number of worker processes to read and count files in (default None for the number
+        of CPUs). With one worker, files are counted in this process. Must be at least 1.
 
     Returns
     -------
     tuple
-        tfidf, feature_map, word_documents : (ndarray, dict, defaultdict)
+        bktree, document_names, word_documents, word_counts : (BKTree, list, dict, defaultdict)
+        Documents are referred to by their index in document_names, and word_documents maps
+        each word to an array('i') of the documents containing it, in increasing order.
     """
-    print('Processing...')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    elif workers < 1:
+        raise ValueError(f'workers must be at least 1, got {workers}')
 
-    bktree = BKTree(fuzzy_ratio_distance)
+    print('Processing...')
 
-    slovenian_alphabet = set("abcčćdđeéfghijklmnoópqrsštuvwxyzž ")
-    word_documents = defaultdict(list)
+    word_documents = {}
+    _get_documents = word_documents.get
     word_counts = defaultdict(int)
-    documents = []
+    entries = list(_walk_txt(text_path))
+    transcriptions = [entry.path for entry in entries]
+    document_names = [entry.name for entry in entries]
+    # documents = [None] * len(transcriptions)
 
-    for transcription in Path(text_path).rglob('*.txt'):
-        text = io.open(transcription, mode='r', encoding="utf-8").read().lower()
-        words = ''.join([c for c in text if c in slovenian_alphabet]).split()
-        doc = str(transcription.name)
+    # Files are read and counted in worker processes, and merged here in document order
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        batches = [transcriptions[i:i + _FILES_PER_TASK] for i in range(0, len(transcriptions), _FILES_PER_TASK)]
+        file_counts = chain.from_iterable(_map_ahead(
+            executor, partial(_count_files, stop_words=stop_words), batches, workers * _BATCHES_AHEAD_PER_WORKER
+        ))
+    else:
+        # Counting holds the GIL, but reading releases it, so threads can read the next files meanwhile
+        executor = ThreadPoolExecutor(max_workers=_READ_THREADS)
+        file_counts = map(
+            partial(_count_text_words, stop_words=stop_words),
+            _map_ahead(executor, _read_file, transcriptions, _FILES_READ_AHEAD)
+        )
 
-        entity_counts = defaultdict(int)
-        for word in words:
-            if word in stop_words:
-                continue
-            entity_counts[word] += 1           
+    with executor:
+        for doc, entity_counts in enumerate(file_counts):
+            for word, count in entity_counts.items():
+                docs = _get_documents(word)
+                if docs is None:
+                    # Interned on first sight, so the index and the BK-tree share one string per word
+                    word = _intern(word)
+                    word_documents[word] = array('i', (doc,))
+                else:
+                    docs.append(doc)
+                word_counts[word] += count
 
-        for word, count in sorted(entity_counts.items(), key=lambda item: item[1], reverse=True):
-            if word not in word_documents:
-                bktree.add(word)
-            word_documents[word].append(doc)
-            word_counts[word] += count
+            # documents[doc] = entity_counts
 
-        # documents.append([" ".join([word for word in words if word not in stop_words])])
+    # The tree is built once the vocabulary is known, in a fixed shuffled order so its shape
+    # does not depend on which words happen to appear in the first files
+    vocabulary = list(word_documents)
+    random.Random(_BKTREE_SEED).shuffle(vocabulary)
+    bktree = BKTree(fuzzy_ratio_distance)
+    _bktree_add = bktree.add
+    for word in vocabulary:
+        _bktree_add(word)
 
     # print('Computing TF-IDF...')
-    # tfidf, feature_map = compute_tfidf(documents, list(stop_words.keys()))
+    # tfidf, feature_map = compute_tfidf(documents)
+
+    return bktree, document_names, word_documents, word_counts #, tfidf, feature_map
+
+def _positive_int(value):
+    """
+    Parses a command line argument as an integer of at least 1.
 
-    return bktree, word_documents, word_counts #, tfidf, feature_map
+    Parameters
+    ----------
+    value : str
+        Argument value.
 
-def run_indexing(transcriptions_dir, index_output_dir, stop_words_path):
+    Returns
+    -------
+    int
+        The parsed value.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {number}')
+    return number
+
+def run_indexing(transcriptions_dir, index_output_dir, stop_words_path, workers=None):
     # Ensure the output directory exists
     os.makedirs(index_output_dir, exist_ok=True)
 
     if stop_words_path == "":
-        stop_words = {}
+        stop_words = frozenset()
     else:
-        stop_words = { w : 0 for w in io.open(stop_words_path, mode='r', encoding="utf-8").read().split(',')}
+        stop_words = frozenset(io.open(stop_words_path, mode='r', encoding="utf-8").read().split(','))
     
-    bktree, word_documents, word_counts = index_files(transcriptions_dir, stop_words)
+    bktree, document_names, word_documents, word_counts = index_files(transcriptions_dir, stop_words, workers)
 
     print("Exporting indexes...")
 
-    bktree.save_to_file(f'{index_output_dir}/bktree.json')
+    bktree.save_to_file(f'{index_output_dir}/bktree.pickle')
 
-    # with open(f'{index_output_dir}/tfidf.pickle', 'wb') as handle:
-    #     pickle.dump(tfidf, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # dump_pickle(tfidf, f'{index_output_dir}/tfidf.pickle')
 
     # with open(f'{index_output_dir}/feature_map.pickle', 'wb') as handle:
     #     pickle.dump(feature_map, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-    with open(f'{index_output_dir}/word_documents.pickle', 'wb') as handle:
-        pickle.dump(word_documents, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(f'{index_output_dir}/documents.pickle', 'wb') as handle:
+        pickle.dump(document_names, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Posting lists are stored concatenated in one array of document IDs, with the list of the
+    # i-th word between offsets i and i + 1, so the file holds no per-word array overhead. Both
+    # arrays use the smallest unsigned integer type that fits, usually 16 bits per document ID
+    postings = array('i')
+    offsets = array('q', (0,))
+    for docs in word_documents.values():
+        postings.extend(docs)
+        offsets.append(len(postings))
+    postings = np.frombuffer(postings, dtype=np.intc).astype(np.min_scalar_type(max(len(document_names) - 1, 0)))
+    offsets = np.frombuffer(offsets, dtype=np.int64).astype(np.min_scalar_type(len(postings)))
+    dump_pickle((list(word_documents), offsets, postings), f'{index_output_dir}/word_documents.pickle')
 
-    with open(f'{index_output_dir}/word_counts.txt', 'w') as file:
-        for w, c in word_counts.items():
-            file.write(f'{w} {c}\n')
+    with open(f'{index_output_dir}/word_counts.txt', 'w', buffering=1 << 20) as file:
+        file.write(''.join([f'{w} {c}\n' for w, c in word_counts.items()]))
     
     print("Done")
 
@@ -119,7 +364,8 @@ if __name__ == '__main__':
     parser.add_argument("--transcriptions_dir", type=str, required=True, help="Path to the directory containing transcription to be indexed.")
     parser.add_argument("--index_output_dir", type=str, required=True, help="Path to the directory to store indexes.")
     parser.add_argument("--stop_words_path", type=str, default="", help="Path to stop words text file.")
+    parser.add_argument("--workers", type=_positive_int, default=None, help="Number of worker processes to read and count files in (default is the number of CPUs).")
     
     args = parser.parse_args()
 
-    run_indexing(args.transcriptions_dir, args.index_output_dir, args.stop_words_path)
\ No newline at end of file
+    run_indexing(args.transcriptions_dir, args.index_output_dir, args.stop_words_path, args.workers)
\ No newline at end of file
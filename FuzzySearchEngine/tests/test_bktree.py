@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bktree import BKTree
+from helper import fuzzy_ratio_distance, fuzzy_ratio_distances
+
+
+WORDS = ['alfa', 'alfaa', 'beta', 'betta', 'gama', 'gamma', 'delta', 'čebela', 'alfa']
+
+
+class SerializationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = BKTree(fuzzy_ratio_distance)
+        for word in WORDS:
+            self.tree.add(word)
+
+    def assert_same_tree(self, loaded):
+        self.assertEqual(loaded.tree, self.tree.tree)
+        self.assertEqual(loaded.word_set, self.tree.word_set)
+        for word in ('alfax', 'gamaa', 'cebela'):
+            self.assertEqual(loaded.find(word, 40), self.tree.find(word, 40))
+
+    def test_list_round_trip(self):
+        loaded = BKTree(fuzzy_ratio_distance)
+        loaded.tree = loaded.from_list(self.tree.to_list())
+        self.assert_same_tree(loaded)
+
+    def test_list_round_trip_interns_items(self):
+        data = [(''.join(item), edges) for item, edges in self.tree.to_list()]
+        loaded = BKTree(fuzzy_ratio_distance)
+        loaded.tree = loaded.from_list(data)
+        self.assertIs(loaded.tree[0], sys.intern('alfa'))
+
+    def test_dict_round_trip(self):
+        loaded = BKTree(fuzzy_ratio_distance)
+        loaded.tree = loaded.from_dict(self.tree.to_dict())
+        self.assert_same_tree(loaded)
+
+    def test_file_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'bktree.pickle')
+            self.tree.save_to_file(filename)
+            loaded = BKTree(fuzzy_ratio_distance, fuzzy_ratio_distances)
+            loaded.load_from_file(filename)
+        self.assert_same_tree(loaded)
+
+    def test_empty_tree_round_trip(self):
+        empty = BKTree(fuzzy_ratio_distance)
+        self.assertEqual(empty.to_list(), [])
+        self.assertIsNone(empty.from_list(empty.to_list()))
+        self.assertIsNone(empty.from_dict(empty.to_dict()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fuzzy_search
+from fuzzy_search import FuzzySearch, _top_k_settled
+from index_files import run_indexing
+
+
+class TopKSettledTest(unittest.TestCase):
+
+    def test_float32_gap_equal_to_bound_is_not_settled(self):
+        # 2/3 - 1/3 rounds above 1/3 in float32, but one more word brings the second document level
+        document_scores = np.zeros(3, dtype=np.float32)
+        document_scores[[0, 1]] += 1 / 3
+        document_scores[[0]] += 1 / 3
+        self.assertGreater(float(document_scores[0]) - float(document_scores[1]), 1 / 3)
+
+        self.assertFalse(_top_k_settled(document_scores, (1, 2), 1, 3, 5))
+
+    def test_clear_gap_is_settled(self):
+        document_scores = np.array([0.0, 0.1, 0.9], dtype=np.float32)
+
+        self.assertTrue(_top_k_settled(document_scores, (1, 2), 1, 3, 5))
+
+
+class TopDocumentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.search_engine = FuzzySearch.__new__(FuzzySearch)
+        self.search_engine.documents = [f'doc_{i}' for i in range(8)]
+
+    def test_ties_at_kth_score_keep_lowest_ids(self):
+        document_scores = np.array([0.5, 0.25, 0.5, 0.0, 0.75, 0.5, 0.5, 0.25], dtype=np.float32)
+
+        self.assertEqual(
+            self.search_engine._top_documents(document_scores, 3),
+            [('doc_4', 0.75), ('doc_0', 0.5), ('doc_2', 0.5)],
+        )
+
+    def test_zero_scores_and_k_below_one_return_nothing_extra(self):
+        document_scores = np.array([0.0, 0.5, 0.0, 0.5], dtype=np.float32)
+
+        self.assertEqual(self.search_engine._top_documents(document_scores, 5), [('doc_1', 0.5), ('doc_3', 0.5)])
+        self.assertEqual(self.search_engine._top_documents(document_scores, 0), [])
+
+
+def build_index(tmp_dir):
+    transcriptions_dir = os.path.join(tmp_dir, 'transcriptions')
+    index_dir = os.path.join(tmp_dir, 'index')
+    os.makedirs(transcriptions_dir)
+    documents = {'first.txt': 'alfa beta', 'second.txt': 'alfa gama', 'third.txt': 'delta'}
+    for name, text in documents.items():
+        with open(os.path.join(transcriptions_dir, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_indexing(transcriptions_dir, index_dir, '', workers=1)
+    return index_dir
+
+
+class EarlyExitTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.search_engine = FuzzySearch(build_index(cls.tmp_dir.name), '')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def search(self, words, score_func, early_exit):
+        if early_exit:
+            return self.search_engine.search_bktree(words, 1, score_func, 5)
+        with mock.patch.object(fuzzy_search, '_top_k_settled', return_value=False):
+            return self.search_engine.search_bktree(words, 1, score_func, 5)
+
+    def test_tied_scores_match_full_scoring(self):
+        # Both documents end with a score of 2/3, whichever of them leads after two words
+        for score_func in (FuzzySearch.score_match_query_ratio, FuzzySearch.score_match_query_ratio_with_penalty):
+            for words in (['alfa', 'beta', 'gama'], ['alfa', 'gama', 'beta']):
+                with self.subTest(score_func=score_func.__name__, words=words):
+                    full = self.search(words, score_func, early_exit=False)
+                    self.assertEqual(
+                        {name for name, _ in self.search(words, score_func, early_exit=True)},
+                        {name for name, _ in full},
+                    )
+
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.index_dir = build_index(self.tmp_dir.name)
+
+    def test_workers_match_local_search_and_shut_down_on_exit(self):
+        query = 'alfa betta gamma delta'
+        with FuzzySearch(self.index_dir, '') as search_engine:
+            search_engine._max_workers = 1
+            local = search_engine.find_relevant_documents(query, 3)
+            search_engine._max_workers = 2
+            self.assertEqual(search_engine.find_relevant_documents(query, 3), local)
+            executor = search_engine._executor
+            self.assertIsNotNone(executor)
+
+        self.assertIsNone(search_engine._executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(len, '')
+
+    def test_close_without_workers_and_twice(self):
+        search_engine = FuzzySearch(self.index_dir, '')
+        search_engine.close()
+        search_engine.close()
+        self.assertIsNone(search_engine._executor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helper import dump_pickle, load_pickle
+
+
+class PickleFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.filename = os.path.join(self.tmp_dir.name, 'data.pickle')
+
+    def test_round_trip_with_buffers(self):
+        words = ['alfa', 'beta', 'čebela']
+        offsets = np.array([0, 2, 3, 5], dtype=np.uint8)
+        postings = np.array([0, 1, 1, 0, 2], dtype=np.uint16)
+        dump_pickle((words, offsets, postings), self.filename)
+
+        loaded_words, loaded_offsets, loaded_postings = load_pickle(self.filename)
+        self.assertEqual(loaded_words, words)
+        np.testing.assert_array_equal(loaded_offsets, offsets)
+        self.assertEqual(loaded_offsets.dtype, offsets.dtype)
+        np.testing.assert_array_equal(loaded_postings, postings)
+        self.assertEqual(loaded_postings.dtype, postings.dtype)
+        self.assertTrue(loaded_postings.flags.writeable)
+
+    def test_round_trip_without_buffers(self):
+        data = [('alfa', [(12, 1)]), ('alfaa', [])]
+        dump_pickle(data, self.filename)
+        self.assertEqual(load_pickle(self.filename), data)
+
+    def test_plain_pickle_asks_for_rebuild(self):
+        with open(self.filename, 'wb') as f:
+            pickle.dump(['alfa', 'beta'], f, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.assertRaisesRegex(ValueError, 'rebuild the index'):
+            load_pickle(self.filename)
+
+    def test_truncated_file_asks_for_rebuild(self):
+        dump_pickle((['alfa'], np.arange(100, dtype=np.int32)), self.filename)
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+
+        # Cuts inside the format tag, the buffer count, a buffer length, the buffer and the stream
+        for size in (4, 12, 20, 100, len(data) - 1):
+            with self.subTest(size=size):
+                with open(self.filename, 'wb') as f:
+                    f.write(data[:size])
+                with self.assertRaisesRegex(ValueError, 'rebuild the index'):
+                    load_pickle(self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()